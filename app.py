@@ -1,5 +1,12 @@
 import os
 import time
+import functools
+import json
+import shutil
+import threading
+import queue
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
 from flask import Flask, request, jsonify, send_from_directory
@@ -10,6 +17,9 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email import encoders
 import smtplib
+import sqlite3
+from sqlalchemy import event, insert
+from sqlalchemy.engine import Engine
 from dotenv import load_dotenv
 import logging
 
@@ -27,7 +37,10 @@ EMAIL_RECIPIENT = os.getenv('EMAIL_RECIPIENT')
 KNOWN_FACES_DIR = "./known_faces"
 ANNOTATED_IMAGES_DIR = "./annotated_images"
 UPLOAD_FOLDER = './uploads'
+MODEL_FILE = './lbph.yml'
+MODEL_META_FILE = './lbph_labels.json'
 DATABASE_FILE = 'sqlite:///database.db'
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Copie du fichier téléversé par blocs de 1 Mo
 
 # Initialisation de l'application Flask
 app = Flask(__name__)
@@ -40,30 +53,190 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Limite : 16 Mo
 # Initialisation de la base de données
 db = SQLAlchemy(app)
 
+# Réglages SQLite appliqués à chaque connexion du pool :
+# WAL pour que les lectures ne bloquent pas les écritures, et un seul fsync par checkpoint
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-20000")
+    cursor.close()
+
 # Création des dossiers nécessaires
 os.makedirs(KNOWN_FACES_DIR, exist_ok=True)
 os.makedirs(ANNOTATED_IMAGES_DIR, exist_ok=True)
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 # Modèle LBPH pour la reconnaissance faciale
-face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+CASCADE_FILE = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+# La cascade CUDA n'accepte que l'ancien format HAAR (dossier haarcascades_cuda des sources OpenCV)
+CUDA_CASCADE_FILE = os.getenv('CUDA_CASCADE_FILE', './haarcascades_cuda/haarcascade_frontalface_default.xml')
+DETECTION_MAX_SIZE = 640  # côté max de l'image pour la détection sur CPU
+MAX_FACES = 16  # capacité initiale du tampon de visages recadrés
+
+@functools.lru_cache(maxsize=None)
+def cuda_available():
+    # Appelé à la première détection seulement : un contexte CUDA créé avant un fork est inutilisable
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        return False
+
+def create_cuda_cascade():
+    try:
+        cascade = cv2.cuda.CascadeClassifier_create(CUDA_CASCADE_FILE)
+    except cv2.error as e:
+        app.logger.warning(f"Cascade CUDA indisponible ({CUDA_CASCADE_FILE}), détection sur CPU : {e}")
+        return None
+    cascade.setScaleFactor(1.1)
+    cascade.setMinNeighbors(5)
+    cascade.setMinObjectSize((30, 30))
+    return cascade
+
+# detectMultiScale n'est pas thread-safe : chaque thread de requête a sa propre cascade
+_detectors = threading.local()
+
+def get_face_cascade():
+    if not hasattr(_detectors, "cascade"):
+        cascade = create_cuda_cascade() if cuda_available() else None
+        _detectors.is_cuda = cascade is not None
+        _detectors.cascade = cascade if cascade is not None else cv2.CascadeClassifier(CASCADE_FILE)
+    return _detectors.cascade, _detectors.is_cuda
+
+# Le modèle LBPH est partagé entre les threads : les prédictions sont sérialisées
 face_recognizer = cv2.face.LBPHFaceRecognizer_create()
+face_recognizer_lock = threading.Lock()
 
 # Variable globale pour stocker le label_map
 label_map = None
 
+# Tampons d'images propres à chaque thread de traitement
+_buffers = threading.local()
+
+# Envoi des alertes hors du chemin de la requête, une connexion SMTP conservée par thread
+EMAIL_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="email")
+_smtp_local = threading.local()
+
+# Écritures disque des images annotées en arrière-plan
+IO_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="io")
+ANNOTATED_JPEG_QUALITY = 85
+
 # Modèle pour les événements détectés
 class DetectionEvent(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     image_path = db.Column(db.String(120), nullable=False)
     annotated_image_path = db.Column(db.String(120), nullable=True)
 
 # Création de la base de données au démarrage
 with app.app_context():
     db.create_all()
+    # create_all ne modifie pas une table existante : ajouter l'index sur les anciennes bases
+    db.session.execute(db.text(
+        "CREATE INDEX IF NOT EXISTS ix_detection_event_timestamp ON detection_event (timestamp)"
+    ))
+    db.session.commit()
+
+# Tampon d'écriture : les événements sont insérés par lots (un seul commit par lot)
+EVENT_BATCH_SIZE = 100
+EVENT_FLUSH_INTERVAL = 0.25  # secondes
+pending_events = queue.Queue()
+_event_writer = None
+_event_writer_lock = threading.Lock()
+_STOP_EVENT_WRITER = object()
+
+def drain_events(max_items, timeout):
+    # Renvoie le lot et un booléen indiquant si l'arrêt du thread a été demandé
+    # Le lot reste ouvert pendant `timeout` après le premier événement, ou jusqu'à max_items
+    batch = []
+    try:
+        item = pending_events.get(timeout=timeout)
+        deadline = time.monotonic() + timeout
+        while item is not _STOP_EVENT_WRITER:
+            batch.append(item)
+            if len(batch) >= max_items:
+                break
+            item = pending_events.get(timeout=max(0, deadline - time.monotonic()))
+        else:
+            return batch, True
+    except queue.Empty:
+        pass
+    return batch, False
+
+def flush_events(batch):
+    if not batch:
+        return
+    with app.app_context():
+        try:
+            db.session.execute(insert(DetectionEvent), batch)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Erreur lors de l'enregistrement de {len(batch)} événements : {e}")
+
+def event_writer_loop():
+    stop = False
+    while not stop:
+        batch, stop = drain_events(EVENT_BATCH_SIZE, EVENT_FLUSH_INTERVAL)
+        flush_events(batch)
+
+def record_event(image_path, annotated_image_path):
+    global _event_writer
+    # Thread démarré à la première utilisation, donc dans le bon processus après un fork
+    if _event_writer is None:
+        with _event_writer_lock:
+            if _event_writer is None:
+                _event_writer = threading.Thread(target=event_writer_loop, name="event-writer", daemon=True)
+                _event_writer.start()
+    pending_events.put({
+        "timestamp": datetime.utcnow(),
+        "image_path": image_path,
+        "annotated_image_path": annotated_image_path,
+    })
+
+@atexit.register
+def stop_event_writer():
+    # Le thread vide la file jusqu'au marqueur d'arrêt, y compris le lot en cours d'écriture
+    if _event_writer is not None:
+        pending_events.put(_STOP_EVENT_WRITER)
+        _event_writer.join()
+
+def write_file(path, data):
+    try:
+        with open(path, 'wb') as f:
+            f.write(data)
+    except OSError as e:
+        app.logger.error(f"Erreur lors de l'écriture de {path} : {e}")
+
+def get_smtp_connection():
+    server = getattr(_smtp_local, "server", None)
+    if server is None:
+        server = smtplib.SMTP("smtp.gmail.com", 587)
+        try:
+            server.starttls()
+            server.login(EMAIL_SENDER, EMAIL_PASSWORD)
+        except Exception:
+            server.close()
+            raise
+        _smtp_local.server = server
+    return server
+
+def close_smtp_connection():
+    server = getattr(_smtp_local, "server", None)
+    _smtp_local.server = None
+    if server is None:
+        return
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
 
-def send_alert_email(image_path):
+def send_alert_email(image_bytes, filename):
     try:
         subject = "⚠️ Alerte de sécurité : Visage inconnu détecté"
         body = "Un visage inconnu a été détecté par le système de sécurité. Veuillez vérifier l'image en pièce jointe."
@@ -74,20 +247,21 @@ def send_alert_email(image_path):
         message["Subject"] = subject
         message.attach(MIMEText(body, "plain"))
 
-        with open(image_path, "rb") as attachment:
-            part = MIMEBase("application", "octet-stream")
-            part.set_payload(attachment.read())
+        part = MIMEBase("application", "octet-stream")
+        part.set_payload(image_bytes)
         encoders.encode_base64(part)
         part.add_header(
             "Content-Disposition",
-            f"attachment; filename={os.path.basename(image_path)}"
+            f"attachment; filename={filename}"
         )
         message.attach(part)
 
-        with smtplib.SMTP("smtp.gmail.com", 587) as server:
-            server.starttls()
-            server.login(EMAIL_SENDER, EMAIL_PASSWORD)
-            server.send_message(message)
+        try:
+            get_smtp_connection().send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            # Connexion fermée par le serveur (inactivité) : on se reconnecte une fois
+            close_smtp_connection()
+            get_smtp_connection().send_message(message)
 
         app.logger.info("Alerte email envoyée avec l'image annotée.")
     except Exception as e:
@@ -135,31 +309,103 @@ def train_model():
     app.logger.info("Modèle entraîné avec succès !")
     return label_map
 
+def known_faces_mtime():
+    # Ajouter ou retirer une image modifie le mtime du dossier du label : pas besoin de lire les fichiers
+    mtime = os.stat(KNOWN_FACES_DIR).st_mtime
+    with os.scandir(KNOWN_FACES_DIR) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                mtime = max(mtime, entry.stat().st_mtime)
+    return mtime
+
+def load_or_train_model():
+    mtime = known_faces_mtime()
+    try:
+        with open(MODEL_META_FILE) as f:
+            meta = json.load(f)
+        if meta["known_faces_mtime"] == mtime and os.path.exists(MODEL_FILE):
+            face_recognizer.read(MODEL_FILE)
+            app.logger.info("Modèle LBPH chargé depuis le cache.")
+            return {int(label_id): name for label_id, name in meta["label_map"].items()}
+    except (OSError, ValueError, KeyError, cv2.error) as e:
+        app.logger.info(f"Cache du modèle indisponible, réentraînement : {e}")
+
+    label_map = train_model()
+    face_recognizer.write(MODEL_FILE)
+    with open(MODEL_META_FILE, 'w') as f:
+        json.dump({"known_faces_mtime": mtime, "label_map": label_map}, f)
+    return label_map
+
+def get_buffer(name, shape):
+    # Tampons réutilisés par thread : pas d'allocation à chaque requête tant que la taille ne change pas
+    buffer = getattr(_buffers, name, None)
+    if buffer is None or buffer.shape != shape:
+        buffer = np.empty(shape, dtype=np.uint8)
+        setattr(_buffers, name, buffer)
+    return buffer
+
+def get_face_crops(count):
+    # Tampon (MAX_FACES, 200, 200) alloué une fois par thread, agrandi seulement si nécessaire
+    buffer = getattr(_buffers, "face_crops", None)
+    if buffer is None or len(buffer) < count:
+        buffer = np.empty((max(MAX_FACES, count), 200, 200), dtype=np.uint8)
+        _buffers.face_crops = buffer
+    return buffer[:count]
+
+def detect_faces(gray_image):
+    face_cascade, is_cuda = get_face_cascade()
+    if is_cuda:
+        gpu_image = cv2.cuda_GpuMat()
+        gpu_image.upload(gray_image)
+        return face_cascade.convert(face_cascade.detectMultiScale(gpu_image))
+
+    # Le coût de la cascade croît avec le nombre de pixels : détecter sur une image réduite
+    height, width = gray_image.shape[:2]
+    scale = min(1.0, DETECTION_MAX_SIZE / max(height, width))
+    if scale == 1.0:
+        small_image = gray_image
+    else:
+        small_width, small_height = round(width * scale), round(height * scale)
+        small_image = cv2.resize(gray_image, (small_width, small_height),
+                                 dst=get_buffer("detection", (small_height, small_width)),
+                                 interpolation=cv2.INTER_AREA)
+
+    min_size = max(24, round(30 * scale))
+    faces = face_cascade.detectMultiScale(
+        small_image,
+        scaleFactor=1.1,
+        minNeighbors=5,
+        minSize=(min_size, min_size)
+    )
+    # Coordonnées ramenées à l'image d'origine pour le recadrage en pleine résolution
+    return [tuple(int(v / scale) for v in rect) for rect in faces]
+
 def detect_and_recognize_faces(image_path, label_map):
     try:
-        image = cv2.imread(image_path)
-        if image is None:
+        # Décodage direct en niveaux de gris : la couleur ne sert qu'à l'image annotée
+        image_data = np.fromfile(image_path, dtype=np.uint8)
+        gray_image = cv2.imdecode(image_data, cv2.IMREAD_GRAYSCALE)
+        if gray_image is None:
             app.logger.error("L'image n'a pas pu être chargée.")
             raise ValueError("L'image est invalide ou corrompue.")
 
-        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        faces = face_cascade.detectMultiScale(
-            gray_image,
-            scaleFactor=1.1,
-            minNeighbors=5,
-            minSize=(30, 30)
-        )
+        faces = detect_faces(gray_image)
 
         if len(faces) == 0:
             app.logger.warning("Aucun visage détecté.")
             return False, None
 
-        face_detected = False
-        for (x, y, w, h) in faces:
-            face = gray_image[y:y+h, x:x+w]
-            face = cv2.resize(face, (200, 200))
+        image = cv2.imdecode(image_data, cv2.IMREAD_COLOR)
+
+        # Tous les visages recadrés dans un seul tableau (N, 200, 200)
+        face_crops = get_face_crops(len(faces))
+        for i, (x, y, w, h) in enumerate(faces):
+            cv2.resize(gray_image[y:y+h, x:x+w], (200, 200), dst=face_crops[i])
 
-            label, confidence = face_recognizer.predict(face)
+        face_detected = False
+        for (x, y, w, h), face in zip(faces, face_crops):
+            with face_recognizer_lock:
+                label, confidence = face_recognizer.predict(face)
             name = label_map.get(label, "Inconnu") if confidence < 50 else "Inconnu"
 
             color = (0, 255, 0) if name != "Inconnu" else (0, 0, 255)
@@ -169,12 +415,17 @@ def detect_and_recognize_faces(image_path, label_map):
             if name == "Inconnu":
                 face_detected = True
 
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
         annotated_image_path = os.path.join(ANNOTATED_IMAGES_DIR, f"annotated_{timestamp}.jpg")
-        cv2.imwrite(annotated_image_path, image)
+        ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, ANNOTATED_JPEG_QUALITY])
+        if not ok:
+            raise ValueError("L'image annotée n'a pas pu être encodée.")
+        annotated_bytes = encoded.tobytes()
 
+        # L'écriture sur disque et l'email utilisent le même encodage, hors du chemin de la requête
+        IO_POOL.submit(write_file, annotated_image_path, annotated_bytes)
         if face_detected:
-            send_alert_email(annotated_image_path)
+            EMAIL_POOL.submit(send_alert_email, annotated_bytes, os.path.basename(annotated_image_path))
 
         return face_detected, annotated_image_path
     except cv2.error as e:
@@ -184,6 +435,17 @@ def detect_and_recognize_faces(image_path, label_map):
         app.logger.error(f"Erreur pendant la détection et reconnaissance des visages : {e}")
         raise
 
+def save_upload(file, index=None):
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    # L'index distingue les parties d'un même lot envoyées sous le même nom
+    prefix = timestamp if index is None else f"{timestamp}_{index}"
+    filename = f"{prefix}_{file.filename}"
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    app.logger.info(f"Sauvegarde du fichier : {file_path}")
+    with open(file_path, 'wb') as f:
+        shutil.copyfileobj(file.stream, f, UPLOAD_CHUNK_SIZE)
+    return filename, file_path
+
 @app.route('/upload', methods=['POST'])
 def upload_and_analyze_image():
     global label_map  # Assure que label_map est accessible
@@ -199,11 +461,7 @@ def upload_and_analyze_image():
             return jsonify({"error": "Aucun fichier sélectionné."}), 400
 
         # Sauvegarder le fichier
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"{timestamp}_{file.filename}"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        app.logger.info(f"Sauvegarde du fichier : {file_path}")
-        file.save(file_path)
+        filename, file_path = save_upload(file)
 
         # Vérifier si le modèle est prêt
         if label_map is None:
@@ -216,10 +474,8 @@ def upload_and_analyze_image():
         app.logger.info(f"Analyse terminée. Visage inconnu : {unknown_detected}")
 
         # Ajouter un événement à la base de données
-        event = DetectionEvent(image_path=file_path, annotated_image_path=annotated_image_path)
-        db.session.add(event)
-        db.session.commit()
-        app.logger.info("Événement enregistré dans la base de données.")
+        record_event(file_path, annotated_image_path)
+        app.logger.info("Événement mis en file pour la base de données.")
 
         return jsonify({
             "message": "Image reçue et analysée.",
@@ -230,6 +486,56 @@ def upload_and_analyze_image():
         app.logger.error(f"Erreur pendant le traitement de l'image : {e}")
         return jsonify({"error": "Erreur interne du serveur"}), 500
 
+@app.route('/upload_batch', methods=['POST'])
+def upload_and_analyze_batch():
+    global label_map
+    app.logger.info("Requête reçue pour téléversement d'un lot d'images.")
+    try:
+        files = [file for file in request.files.getlist('file') if file.filename != '']
+        if not files:
+            app.logger.error("Aucun fichier trouvé dans la requête.")
+            return jsonify({"error": "Aucun fichier envoyé. Utilisez le champ 'file'."}), 400
+
+        # Sauvegarder les fichiers en parallèle
+        saved = list(IO_POOL.map(save_upload, files, range(len(files))))
+
+        if label_map is None:
+            app.logger.error("Le modèle LBPH n'a pas été entraîné.")
+            return jsonify({"error": "Le modèle n'a pas été entraîné. Ajoutez des visages connus."}), 500
+
+        results = []
+        rows = []
+        for filename, file_path in saved:
+            # Une image invalide ne doit pas faire échouer le reste du lot
+            try:
+                unknown_detected, annotated_image_path = detect_and_recognize_faces(file_path, label_map)
+            except Exception as e:
+                app.logger.error(f"Erreur pendant l'analyse de {filename} : {e}")
+                results.append({"filename": filename, "error": "Erreur pendant l'analyse de l'image."})
+                continue
+            results.append({"filename": filename, "unknown_detected": unknown_detected})
+            rows.append({
+                "timestamp": datetime.utcnow(),
+                "image_path": file_path,
+                "annotated_image_path": annotated_image_path,
+            })
+
+        # executemany dans une seule transaction pour tout le lot
+        if rows:
+            db.session.execute(insert(DetectionEvent), rows)
+            db.session.commit()
+            app.logger.info(f"{len(rows)} événements enregistrés dans la base de données.")
+
+        return jsonify({
+            "message": "Images reçues et analysées.",
+            "results": results
+        }), 200
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Erreur pendant le traitement du lot d'images : {e}")
+        return jsonify({"error": "Erreur interne du serveur"}), 500
+
 if __name__ == '__main__':
-    label_map = train_model()  # Entraîne le modèle et initialise globalement label_map
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    label_map = load_or_train_model()  # Charge ou entraîne le modèle et initialise globalement label_map
+    # Serveur de développement uniquement ; en production : ./start.sh (gunicorn)
+    app.run(debug=bool(os.environ.get('FLASK_DEV')), host='0.0.0.0', port=5000)
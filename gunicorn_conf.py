@@ -0,0 +1,26 @@
+import multiprocessing
+import os
+
+# Processus pour le travail OpenCV (CPU), threads pour les E/S
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = 4
+timeout = 60
+preload_app = True
+
+def on_starting(server):
+    # Modèle chargé une seule fois dans le maître : les workers le partagent par copie à l'écriture
+    import app
+    try:
+        app.label_map = app.load_or_train_model()
+    except ValueError as e:
+        # Sans visages connus le serveur démarre quand même ; /upload renvoie l'erreur prévue
+        server.log.error(f"Modèle non entraîné : {e}")
+        app.label_map = None
+
+def post_fork(server, worker):
+    # Le worker abandonne le pool hérité du maître sans fermer les connexions de celui-ci
+    from app import app as flask_app, db
+    with flask_app.app_context():
+        db.engine.dispose(close=False)
@@ -1,2 +1,3 @@
 #!/bin/bash
-gunicorn app:app --bind 0.0.0.0:$PORT
+export MALLOC_ARENA_MAX=2
+gunicorn -c gunicorn_conf.py app:app